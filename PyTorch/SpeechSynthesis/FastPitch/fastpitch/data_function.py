@@ -25,17 +25,21 @@
 #
 # *****************************************************************************
 
+import collections
 import functools
 import json
+import math
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import librosa
 import numpy as np
 import torch
 import torch.nn.functional as F
-from scipy import ndimage
-from scipy.stats import betabinom
+from torch.nn.utils.rnn import pad_sequence
+from numba import jit
 
 import common.layers as layers
 from common.text.text_processing import TextProcessing
@@ -47,35 +51,90 @@ class BetaBinomialInterpolator:
 
     Calculating beta-binomial priors is costly. Instead cache popular sizes
     and use img interpolation to get priors faster.
+
+    Cached sizes are looked up in-process, then in an optional dict shared
+    between DataLoader workers (e.g., multiprocessing.Manager().dict()),
+    then on disk, and only then calculated.
     """
-    def __init__(self, round_mel_len_to=100, round_text_len_to=20):
+    def __init__(self, round_mel_len_to=100, round_text_len_to=20,
+                 cache_dir=None, shared_bank=None):
         self.round_mel_len_to = round_mel_len_to
         self.round_text_len_to = round_text_len_to
-        self.bank = functools.lru_cache(beta_binomial_prior_distribution)
+        self.cache_dir = None if cache_dir is None else Path(cache_dir, 'bank')
+        self.shared_bank = shared_bank
+        self.bank = functools.lru_cache(self._fetch)
+
+        # Warm up the in-memory cache before DataLoader workers are forked
+        if self.cache_dir is not None and self.cache_dir.is_dir():
+            for fpath in self.cache_dir.glob('*_*.pt'):
+                self.bank(*map(int, fpath.stem.split('_')))
+
+    def _fetch(self, bw, bh):
+        if self.shared_bank is None:
+            return self._load_or_compute(bw, bh)
+
+        # Share ndarrays, which pickle without torch's shared memory handles
+        prior = self.shared_bank.get((bw, bh))
+        if prior is None:
+            prior = self._load_or_compute(bw, bh).numpy()
+            self.shared_bank[(bw, bh)] = prior
+        return torch.from_numpy(prior)
+
+    def _load_or_compute(self, bw, bh):
+        if self.cache_dir is None:
+            return beta_binomial_prior_distribution(bw, bh)
+
+        cached_fpath = Path(self.cache_dir, f'{bw}_{bh}.pt')
+        if cached_fpath.is_file():
+            return torch.load(cached_fpath)
+
+        prior = beta_binomial_prior_distribution(bw, bh)
+
+        # Write and rename, so that concurrent workers never see partial files
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_fpath = cached_fpath.with_suffix(f'.{os.getpid()}.tmp')
+        torch.save(prior, tmp_fpath)
+        tmp_fpath.replace(cached_fpath)
+        return prior
 
     def round(self, val, to):
-        return max(1, int(np.round((val + 1) / to))) * to
+        return max(to, int(np.round(val / to)) * to)
 
     def __call__(self, w, h):
         bw = self.round(w, to=self.round_mel_len_to)
         bh = self.round(h, to=self.round_text_len_to)
-        ret = ndimage.zoom(self.bank(bw, bh).T, zoom=(w / bw, h / bh), order=1)
+        # Bilinear ndimage.zoom(..., order=1), but much faster. Unlike zoom,
+        # it never zeroes the last row/column due to float rounding
+        prior = self.bank(bw, bh).T[None, None]
+        ret = F.interpolate(prior, size=(w, h), mode='bilinear',
+                            align_corners=True)[0, 0]
         assert ret.shape[0] == w, ret.shape
         assert ret.shape[1] == h, ret.shape
         return ret
 
 
+@jit(nopython=True, fastmath=True, cache=True)
+def betabinom_fill(out, P, M, scaling):
+    """Fills (M, P) out with the beta-binomial PMF of every mel frame"""
+    # Log of C(n, k) B(k + a, n - k + b) / B(a, b), split into terms
+    # which depend only on k, only on the mel frame, or on both
+    log_binom = np.empty(P)
+    for k in range(P):
+        log_binom[k] = (math.lgamma(P + 1) - math.lgamma(k + 1)
+                        - math.lgamma(P - k + 1))
+    for i in range(M):
+        a, b = scaling * (i + 1), scaling * (M - i)
+        log_norm = (math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+                    - math.lgamma(P + a + b))
+        for k in range(P):
+            out[i, k] = math.exp(log_binom[k] + log_norm
+                                 + math.lgamma(k + a) + math.lgamma(P - k + b))
+
+
 def beta_binomial_prior_distribution(phoneme_count, mel_count, scaling=1.0):
-    P = phoneme_count
-    M = mel_count
-    x = np.arange(0, P)
-    mel_text_probs = []
-    for i in range(1, M+1):
-        a, b = scaling * i, scaling * (M + 1 - i)
-        rv = betabinom(P, a, b)
-        mel_i_prob = rv.pmf(x)
-        mel_text_probs.append(mel_i_prob)
-    return torch.tensor(np.array(mel_text_probs))
+    mel_text_probs = np.empty((mel_count, phoneme_count))
+    betabinom_fill(mel_text_probs, phoneme_count, mel_count, float(scaling))
+    return torch.from_numpy(mel_text_probs)
 
 
 def estimate_pitch(wav, mel_len, method='pyin', normalize_mean=None,
@@ -152,7 +211,10 @@ class TTSDataset(torch.utils.data.Dataset):
                  pitch_online_dir=None,
                  betabinomial_online_dir=None,
                  use_betabinomial_interpolator=True,
+                 share_betabinomial_bank=False,
                  pitch_online_method='pyin',
+                 packed_dataset_dir=None,
+                 text_online=False,
                  **ignored):
 
         # Expect a list of filenames
@@ -180,6 +242,7 @@ class TTSDataset(torch.utils.data.Dataset):
             'Variable probability breaks caching of betabinomial matrices.')
 
         self.tp = TextProcessing(symbol_set, text_cleaners, p_arpabet=p_arpabet)
+        self.space = [self.tp.encode_text("A A")[1]]
         self.n_speakers = n_speakers
         self.pitch_tmp_dir = pitch_online_dir
         self.f0_method = pitch_online_method
@@ -187,7 +250,14 @@ class TTSDataset(torch.utils.data.Dataset):
         self.use_betabinomial_interpolator = use_betabinomial_interpolator
 
         if use_betabinomial_interpolator:
-            self.betabinomial_interpolator = BetaBinomialInterpolator()
+            shared_bank = None
+            if share_betabinomial_bank:
+                # Forked workers inherit a proxy to a single bank
+                self.bank_manager = torch.multiprocessing.Manager()
+                shared_bank = self.bank_manager.dict()
+
+            self.betabinomial_interpolator = BetaBinomialInterpolator(
+                cache_dir=betabinomial_online_dir, shared_bank=shared_bank)
 
         expected_columns = (2 + int(load_pitch_from_disk) + (n_speakers > 1))
 
@@ -200,10 +270,81 @@ class TTSDataset(torch.utils.data.Dataset):
         if len(self.audiopaths_and_text[0]) > expected_columns:
             print('WARNING: Audiopaths file has more columns than expected')
 
+        # Encoding is deterministic with p_arpabet in {0.0, 1.0}, so do it
+        # once instead of in every epoch
+        self.text_online = text_online
+        if not text_online:
+            text_col = -2 if n_speakers > 1 else -1
+            self.encoded_texts = [self.get_text(fields[text_col])
+                                  for fields in self.audiopaths_and_text]
+
+        self.io_pool = None
+        self.io_pool_pid = None
+
+        self.packed_dataset_dir = packed_dataset_dir
+        if packed_dataset_dir is not None:
+            assert load_mel_from_disk and load_pitch_from_disk
+            self._open_packed(packed_dataset_dir)
+
         to_tensor = lambda x: torch.Tensor([x]) if type(x) is float else x
         self.pitch_mean = to_tensor(pitch_mean)
         self.pitch_std = to_tensor(pitch_std)
 
+        # Lengths are known upfront only with packed mels and cached texts
+        if (use_betabinomial_interpolator and packed_dataset_dir is not None
+                and not text_online):
+            self.prime_betabinomial_interpolator()
+
+    def _open_packed(self, packed_dir):
+        """Memory-maps mels, pitch and energy created with pack_dataset.py.
+
+        Maps are opened once and inherited by forked DataLoader workers.
+        """
+        index = np.load(Path(packed_dir, 'index.npz'))
+        root = self.dataset_path
+        self.packed_ids = {str(Path(root, p) if root else Path(p)): i
+                           for i, p in enumerate(index['paths'])}
+        self.packed_offsets = index['offsets']
+        self.packed_mels = np.memmap(
+            Path(packed_dir, 'mels.bin'), dtype=np.float16, mode='r'
+        ).reshape(-1, int(index['n_mel_channels']))
+        self.packed_pitch = np.memmap(
+            Path(packed_dir, 'pitch.bin'), dtype=np.float32, mode='r'
+        ).reshape(-1, int(index['n_formants']))
+        self.packed_energy = np.memmap(
+            Path(packed_dir, 'energy.bin'), dtype=np.float32, mode='r')
+
+    def get_packed(self, packed, audiopath):
+        i = self.packed_ids[audiopath]
+        start, end = self.packed_offsets[i:i+2]
+        return torch.from_numpy(np.array(packed[start:end].T, order='C'))
+
+    def prime_betabinomial_interpolator(self):
+        """Fills the prior bank with the most common sizes.
+
+        Called in the main process, so that DataLoader workers are forked
+        with a warm cache instead of each computing the same priors.
+        """
+        bbi = self.betabinomial_interpolator
+        ids = [self.packed_ids[fields[0]] for fields in self.audiopaths_and_text]
+        mel_lens = np.diff(self.packed_offsets)[ids]
+        text_lens = [len(text) for text in self.encoded_texts]
+
+        buckets = collections.Counter(
+            (bbi.round(w, to=bbi.round_mel_len_to),
+             bbi.round(h, to=bbi.round_text_len_to))
+            for w, h in zip(mel_lens, text_lens))
+        for (bw, bh), _ in buckets.most_common(bbi.bank.cache_info().maxsize):
+            bbi.bank(bw, bh)
+
+    def get_io_pool(self):
+        # Threads do not survive a fork, so every DataLoader worker needs
+        # a pool of its own
+        if self.io_pool_pid != os.getpid():
+            self.io_pool = ThreadPoolExecutor(max_workers=1)
+            self.io_pool_pid = os.getpid()
+        return self.io_pool
+
     def __getitem__(self, index):
         # Separate filename and text
         if self.n_speakers > 1:
@@ -213,10 +354,24 @@ class TTSDataset(torch.utils.data.Dataset):
             audiopath, *extra, text = self.audiopaths_and_text[index]
             speaker = None
 
+        # Reading pitch releases the GIL, so overlap it with loading the mel
+        pitch = None
+        if self.load_pitch_from_disk and self.packed_dataset_dir is None:
+            pitch = self.get_io_pool().submit(self.get_pitch, index)
+
         mel = self.get_mel(audiopath)
-        text = self.get_text(text)
-        pitch = self.get_pitch(index, mel.size(-1))
-        energy = torch.norm(mel.float(), dim=0, p=2)
+        if self.text_online:
+            text = self.get_text(text)
+        else:
+            text = self.encoded_texts[index]
+        if pitch is not None:
+            pitch = pitch.result()
+        else:
+            pitch = self.get_pitch(index, mel.size(-1))
+        if self.packed_dataset_dir is not None:
+            energy = self.get_packed(self.packed_energy, audiopath)
+        else:
+            energy = torch.norm(mel.float(), dim=0, p=2)
         attn_prior = self.get_prior(index, mel.shape[1], text.shape[0])
 
         assert pitch.size(-1) == mel.size(-1)
@@ -228,6 +383,23 @@ class TTSDataset(torch.utils.data.Dataset):
         return (text, mel, len(text), pitch, energy, speaker, attn_prior,
                 audiopath)
 
+    def __getitems__(self, indices):
+        """Loads a whole batch, used by DataLoader fetchers which support it.
+
+        Packed items are loaded in the on-disk order, which turns random
+        access to memory-mapped files into a forward scan, and returned
+        in the requested order.
+        """
+        if self.packed_dataset_dir is None:
+            return [self[i] for i in indices]
+
+        rows = [self.packed_ids[self.audiopaths_and_text[i][0]]
+                for i in indices]
+        items = [None] * len(indices)
+        for j in sorted(range(len(indices)), key=rows.__getitem__):
+            items[j] = self[indices[j]]
+        return items
+
     def __len__(self):
         return len(self.audiopaths_and_text)
 
@@ -237,37 +409,35 @@ class TTSDataset(torch.utils.data.Dataset):
             if sampling_rate != self.stft.sampling_rate:
                 raise ValueError("{} SR doesn't match target {} SR".format(
                     sampling_rate, self.stft.sampling_rate))
-            audio_norm = audio / self.max_wav_value
-            audio_norm = audio_norm.unsqueeze(0)
-            audio_norm = torch.autograd.Variable(audio_norm,
-                                                 requires_grad=False)
-            melspec = self.stft.mel_spectrogram(audio_norm)
-            melspec = torch.squeeze(melspec, 0)
+            with torch.inference_mode():
+                audio_norm = audio.div_(self.max_wav_value).unsqueeze_(0)
+                melspec = self.stft.mel_spectrogram(audio_norm).squeeze_(0)
+        elif self.packed_dataset_dir is not None:
+            melspec = self.get_packed(self.packed_mels, filename)
         else:
             melspec = torch.load(filename)
             # assert melspec.size(0) == self.stft.n_mel_channels, (
             #     'Mel dimension mismatch: given {}, expected {}'.format(
             #         melspec.size(0), self.stft.n_mel_channels))
 
-        return melspec
+        # Mels are upcast on the GPU, fp16 halves the H2D transfer
+        return melspec.half()
 
     def get_text(self, text):
         text = self.tp.encode_text(text)
-        space = [self.tp.encode_text("A A")[1]]
 
         if self.prepend_space_to_text:
-            text = space + text
+            text = self.space + text
 
         if self.append_space_to_text:
-            text = text + space
+            text = text + self.space
 
         return torch.LongTensor(text)
 
     def get_prior(self, index, mel_len, text_len):
 
         if self.use_betabinomial_interpolator:
-            return torch.from_numpy(self.betabinomial_interpolator(mel_len,
-                                                                   text_len))
+            return self.betabinomial_interpolator(mel_len, text_len)
 
         if self.betabinomial_tmp_dir is not None:
             audiopath, *_ = self.audiopaths_and_text[index]
@@ -295,8 +465,11 @@ class TTSDataset(torch.utils.data.Dataset):
             spk = 0
 
         if self.load_pitch_from_disk:
-            pitchpath = fields[0]
-            pitch = torch.load(pitchpath)
+            if self.packed_dataset_dir is not None:
+                pitch = self.get_packed(self.packed_pitch, audiopath)
+            else:
+                pitchpath = fields[0]
+                pitch = torch.load(pitchpath)
             if self.pitch_mean is not None:
                 assert self.pitch_std is not None
                 pitch = normalize_pitch(pitch, self.pitch_mean, self.pitch_std)
@@ -326,7 +499,14 @@ class TTSDataset(torch.utils.data.Dataset):
 
 
 class TTSCollate:
-    """Zero-pads model inputs and targets based on number of frames per step"""
+    """Zero-pads model inputs and targets based on number of frames per step
+
+    With pad_on_gpu=True, mels and alignment priors are returned unpadded and
+    concatenated, and batch_to_gpu pads them on the device. This transfers
+    only the actual frames instead of the whole padded batch.
+    """
+    def __init__(self, pad_on_gpu=False):
+        self.pad_on_gpu = pad_on_gpu
 
     def __call__(self, batch):
         """Collate training batch from normalized text and mel-spec"""
@@ -335,73 +515,91 @@ class TTSCollate:
             torch.LongTensor([len(x[0]) for x in batch]),
             dim=0, descending=True)
         max_input_len = input_lengths[0]
-
-        text_padded = torch.LongTensor(len(batch), max_input_len)
-        text_padded.zero_()
-        for i in range(len(ids_sorted_decreasing)):
-            text = batch[ids_sorted_decreasing[i]][0]
-            text_padded[i, :text.size(0)] = text
+        sorted_batch = [batch[i] for i in ids_sorted_decreasing.tolist()]
 
         # Right zero-pad mel-spec
         num_mels = batch[0][1].size(0)
         max_target_len = max([x[1].size(1) for x in batch])
+        output_lengths = torch.LongTensor([x[1].size(1) for x in sorted_batch])
+
+        n_formants = batch[0][3].size(0)
+        text_padded = torch.zeros(len(batch), max_input_len, dtype=torch.long)
+        pitch_padded = torch.zeros(len(batch), n_formants, max_target_len,
+                                   dtype=batch[0][3].dtype)
+        energy_padded = torch.zeros(len(batch), max_target_len,
+                                    dtype=batch[0][4].dtype)
+        if not self.pad_on_gpu:
+            mel_padded = torch.zeros(len(batch), num_mels, max_target_len,
+                                     dtype=torch.half)
+            attn_prior_padded = torch.zeros(len(batch), max_target_len,
+                                            max_input_len, dtype=torch.half)
+
+        # Fill all padded tensors in a single pass over the batch
+        for i, (text, mel, _, pitch, energy, _, prior, _) in enumerate(sorted_batch):
+            text_padded[i, :text.size(0)] = text
+            pitch_padded[i, :, :pitch.size(1)] = pitch
+            energy_padded[i, :energy.size(0)] = energy
+            if not self.pad_on_gpu:
+                mel_padded[i, :, :mel.size(1)] = mel
+                attn_prior_padded[i, :prior.size(0), :prior.size(1)] = prior
 
-        # Include mel padded and gate padded
-        mel_padded = torch.FloatTensor(len(batch), num_mels, max_target_len)
-        mel_padded.zero_()
-        output_lengths = torch.LongTensor(len(batch))
-        for i in range(len(ids_sorted_decreasing)):
-            mel = batch[ids_sorted_decreasing[i]][1]
-            mel_padded[i, :, :mel.size(1)] = mel
-            output_lengths[i] = mel.size(1)
-
-        n_formants = batch[0][3].shape[0]
-        pitch_padded = torch.zeros(mel_padded.size(0), n_formants,
-                                   mel_padded.size(2), dtype=batch[0][3].dtype)
-        energy_padded = torch.zeros_like(pitch_padded[:, 0, :])
-
-        for i in range(len(ids_sorted_decreasing)):
-            pitch = batch[ids_sorted_decreasing[i]][3]
-            energy = batch[ids_sorted_decreasing[i]][4]
-            pitch_padded[i, :, :pitch.shape[1]] = pitch
-            energy_padded[i, :energy.shape[0]] = energy
+        if self.pad_on_gpu:
+            mel_padded = torch.cat([x[1].t() for x in sorted_batch])
+            attn_prior_padded = torch.cat(
+                [x[6].flatten().half() for x in sorted_batch])
 
         if batch[0][5] is not None:
-            speaker = torch.zeros_like(input_lengths)
-            for i in range(len(ids_sorted_decreasing)):
-                speaker[i] = batch[ids_sorted_decreasing[i]][5]
+            speaker = torch.LongTensor([x[5] for x in sorted_batch])
         else:
             speaker = None
 
-        attn_prior_padded = torch.zeros(len(batch), max_target_len,
-                                        max_input_len)
-        attn_prior_padded.zero_()
-        for i in range(len(ids_sorted_decreasing)):
-            prior = batch[ids_sorted_decreasing[i]][6]
-            attn_prior_padded[i, :prior.size(0), :prior.size(1)] = prior
-
         # Count number of items - characters in text
         len_x = [x[2] for x in batch]
         len_x = torch.Tensor(len_x)
 
-        audiopaths = [batch[i][7] for i in ids_sorted_decreasing]
+        audiopaths = [x[7] for x in sorted_batch]
 
         return (text_padded, input_lengths, mel_padded, output_lengths, len_x,
                 pitch_padded, energy_padded, speaker, attn_prior_padded,
                 audiopaths)
 
 
+def pad_on_gpu(mels, attn_priors, input_lengths, output_lengths):
+    """Pads mels and priors concatenated by TTSCollate(pad_on_gpu=True)"""
+    in_lens = input_lengths.tolist()
+    out_lens = output_lengths.tolist()
+
+    mels = to_gpu(mels).float().split(out_lens)
+    mel_padded = pad_sequence(mels, batch_first=True).transpose(1, 2)
+
+    attn_priors = to_gpu(attn_priors).float().split(
+        [t * s for t, s in zip(out_lens, in_lens)])
+    attn_prior = attn_priors[0].new_zeros(len(out_lens), max(out_lens),
+                                          max(in_lens))
+    for i, (prior, t, s) in enumerate(zip(attn_priors, out_lens, in_lens)):
+        attn_prior[i, :t, :s] = prior.view(t, s)
+
+    return mel_padded.contiguous(), attn_prior
+
+
 def batch_to_gpu(batch):
     (text_padded, input_lengths, mel_padded, output_lengths, len_x,
      pitch_padded, energy_padded, speaker, attn_prior, audiopaths) = batch
 
+    # Unpadded (T, C) mels come from TTSCollate(pad_on_gpu=True)
+    if mel_padded.dim() == 2:
+        mel_padded, attn_prior = pad_on_gpu(mel_padded, attn_prior,
+                                            input_lengths, output_lengths)
+    else:
+        # Mels and priors are sent as fp16 and upcast on the device
+        mel_padded = to_gpu(mel_padded).float()
+        attn_prior = to_gpu(attn_prior).float()
+
     text_padded = to_gpu(text_padded).long()
     input_lengths = to_gpu(input_lengths).long()
-    mel_padded = to_gpu(mel_padded).float()
     output_lengths = to_gpu(output_lengths).long()
     pitch_padded = to_gpu(pitch_padded).float()
     energy_padded = to_gpu(energy_padded).float()
-    attn_prior = to_gpu(attn_prior).float()
     if speaker is not None:
         speaker = to_gpu(speaker).long()
 
@@ -213,7 +213,8 @@ def prepare_input_sequence(fields, device, symbol_set, text_cleaners,
     if load_mels:
         assert 'mel' in fields
         fields['mel'] = [
-            torch.load(Path(dataset, fields['mel'][i])).t() for i in order]
+            torch.load(Path(dataset, fields['mel'][i])).float().t()
+            for i in order]
         fields['mel_lens'] = torch.LongTensor([t.size(0) for t in fields['mel']])
 
     if load_pitch:
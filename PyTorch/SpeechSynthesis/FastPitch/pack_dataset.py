@@ -0,0 +1,100 @@
+# *****************************************************************************
+#  Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#      * Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#      * Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#      * Neither the name of the NVIDIA CORPORATION nor the
+#        names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+#  WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL NVIDIA CORPORATION BE LIABLE FOR ANY
+#  DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#  (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#  LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#  ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#  (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#  SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# *****************************************************************************
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import torch
+import tqdm
+
+from common.utils import load_filepaths_and_text
+
+
+def parse_args(parser):
+    """
+    Parse commandline arguments.
+    """
+    parser.add_argument('-d', '--dataset-path', type=str,
+                        default='./', help='Path to dataset')
+    parser.add_argument('--filelists', required=True, nargs='+', type=str,
+                        help='Files with mel paths, pitch paths and text')
+    parser.add_argument('-o', '--output-dir', type=str, required=True,
+                        help='Directory for the packed dataset')
+    parser.add_argument('--n-speakers', type=int, default=1)
+    return parser
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FastPitch Dataset Packing')
+    parser = parse_args(parser)
+    args, unk_args = parser.parse_known_args()
+    if len(unk_args) > 0:
+        raise ValueError(f'Invalid options {unk_args}')
+
+    has_speakers = args.n_speakers > 1
+    rel_paths = load_filepaths_and_text(args.filelists, None, has_speakers)
+    abs_paths = load_filepaths_and_text(args.filelists, args.dataset_path,
+                                        has_speakers)
+
+    out_dir = Path(args.output_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # Mels, pitch and energy are stored frame-major, so that every utterance
+    # occupies a single contiguous block of the file
+    offsets = [0]
+    n_mel_channels = n_formants = None
+    with open(out_dir / 'mels.bin', 'wb') as mels_f, \
+         open(out_dir / 'pitch.bin', 'wb') as pitch_f, \
+         open(out_dir / 'energy.bin', 'wb') as energy_f:
+
+        for mel_path, pitch_path, *_ in tqdm.tqdm(abs_paths):
+            mel = torch.load(mel_path)
+            pitch = torch.load(pitch_path)
+            if len(pitch.size()) == 1:
+                pitch = pitch[None, :]
+
+            assert pitch.size(-1) == mel.size(-1), mel_path
+            assert n_mel_channels in (None, mel.size(0))
+            assert n_formants in (None, pitch.size(0))
+            n_mel_channels, n_formants = mel.size(0), pitch.size(0)
+
+            mels_f.write(mel.t().half().numpy().tobytes())
+            pitch_f.write(pitch.t().float().numpy().tobytes())
+            energy = torch.norm(mel.float(), dim=0, p=2)
+            energy_f.write(energy.numpy().tobytes())
+            offsets.append(offsets[-1] + mel.size(1))
+
+    np.savez(out_dir / 'index.npz',
+             paths=np.array([p[0] for p in rel_paths]),
+             offsets=np.array(offsets, dtype=np.int64),
+             n_mel_channels=n_mel_channels,
+             n_formants=n_formants)
+
+
+if __name__ == '__main__':
+    main()
@@ -155,7 +155,8 @@ def main():
                 for j, mel in enumerate(mels):
                     fname = Path(fpaths[j]).with_suffix('.pt').name
                     fpath = Path(args.dataset_path, 'mels', fname)
-                    torch.save(mel[:, :mel_lens[j]], fpath)
+                    # Collated mels are fp16, keep fp32 files on disk
+                    torch.save(mel[:, :mel_lens[j]].float(), fpath)
 
             if args.extract_pitch:
                 for j, p in enumerate(pitch):
@@ -167,7 +168,7 @@ def main():
                 for j, prior in enumerate(attn_prior):
                     fname = Path(fpaths[j]).with_suffix('.pt').name
                     fpath = Path(args.dataset_path, 'alignment_priors', fname)
-                    torch.save(prior[:mel_lens[j], :input_lens[j]], fpath)
+                    torch.save(prior[:mel_lens[j], :input_lens[j]].float(), fpath)
 
 
 if __name__ == '__main__':
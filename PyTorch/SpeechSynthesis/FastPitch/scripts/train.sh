@@ -76,6 +76,9 @@ ARGS+=" --n-speakers $NSPEAKERS"
 [ "$LOAD_PITCH_FROM_DISK" = true ] && ARGS+=" --load-pitch-from-disk"
 [ "$PITCH_ONLINE_DIR" != "" ]      && ARGS+=" --pitch-online-dir $PITCH_ONLINE_DIR"  # e.g., /dev/shm/pitch
 [ "$PITCH_ONLINE_METHOD" != "" ]   && ARGS+=" --pitch-online-method $PITCH_ONLINE_METHOD"
+[ "$BETABINOMIAL_ONLINE_DIR" != "" ] && ARGS+=" --betabinomial-online-dir $BETABINOMIAL_ONLINE_DIR"
+[ "$SHARE_BETABINOMIAL_BANK" = true ] && ARGS+=" --share-betabinomial-bank"
+[ "$PACKED_DATASET_DIR" != "" ]    && ARGS+=" --packed-dataset-dir $PACKED_DATASET_DIR"
 [ "$APPEND_SPACES" = true ]        && ARGS+=" --prepend-space-to-text"
 [ "$APPEND_SPACES" = true ]        && ARGS+=" --append-space-to-text"
 
@@ -140,6 +140,8 @@ def parse_args(parser):
                       help='Capture leading silence with a space token')
     data.add_argument('--append-space-to-text', action='store_true',
                       help='Capture trailing silence with a space token')
+    data.add_argument('--packed-dataset-dir', type=str, default=None,
+                      help='Load mels and pitch packed with pack_dataset.py')
 
     cond = parser.add_argument_group('data for conditioning')
     cond.add_argument('--n-speakers', type=int, default=1,
@@ -152,6 +154,12 @@ def parse_args(parser):
                       help='Calculate pitch on the fly during trainig')
     cond.add_argument('--pitch-online-dir', type=str, default=None,
                       help='A directory for storing pitch calculated on-line')
+    cond.add_argument('--betabinomial-online-dir', type=str, default=None,
+                      help='A directory for storing alignment priors '
+                           'calculated on-line')
+    cond.add_argument('--share-betabinomial-bank', action='store_true',
+                      help='Share cached alignment priors between DataLoader '
+                           'workers')
     cond.add_argument('--pitch-mean', type=float, default=214.72203,
                       help='Normalization value for pitch')
     cond.add_argument('--pitch-std', type=float, default=65.72038,
@@ -397,7 +405,7 @@ def validate(model, criterion, valset, batch_size, collate_fn, distributed_run,
         val_sampler = DistributedSampler(valset) if distributed_run else None
         val_loader = DataLoader(valset, num_workers=4, shuffle=False,
                                 sampler=val_sampler,
-                                batch_size=batch_size, pin_memory=False,
+                                batch_size=batch_size, pin_memory=True,
                                 collate_fn=collate_fn)
         val_meta = defaultdict(float)
         val_num_frames = 0
@@ -587,7 +595,7 @@ def main():
         pitch_predictor_loss_scale=args.pitch_predictor_loss_scale,
         attn_loss_scale=args.attn_loss_scale)
 
-    collate_fn = TTSCollate()
+    collate_fn = TTSCollate(pad_on_gpu=True)
 
     if args.local_rank == 0:
         prepare_tmp(args.pitch_online_dir)
@@ -604,6 +612,7 @@ def main():
     train_loader = DataLoader(trainset, num_workers=4, shuffle=shuffle,
                               sampler=train_sampler, batch_size=args.batch_size,
                               pin_memory=True, persistent_workers=True,
+                              prefetch_factor=4,
                               drop_last=True, collate_fn=collate_fn)
 
     if args.ema_decay:
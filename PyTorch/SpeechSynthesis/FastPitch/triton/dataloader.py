@@ -80,6 +80,7 @@ def get_dataloader_fn(batch_size: int = 8,
             text_padded, _, mel_padded, output_lengths, _, \
             pitch_padded, energy_padded, *_ = batch
 
+            mel_padded = mel_padded.float()
             pitch_padded = pitch_padded.float()
             energy_padded = energy_padded.float()
             dur_padded = torch.zeros_like(pitch_padded)